@@ -1,11 +1,21 @@
 import streamlit as st
+import os
+# CPU-only host: hide CUDA devices and silence TensorFlow start-up logs before it is imported
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")
+os.environ.setdefault("TF_CPP_MIN_LOG_LEVEL", "3")
 import tensorflow as tf
-from PIL import Image, ImageOps, ExifTags, ImageEnhance
+from PIL import Image, ExifTags
 import numpy as np
 import cv2
-from keras.models import Model
-from streamlit_image_comparison import image_comparison
 import math
+import hashlib
+import io
+import threading
+
+# Use half the cores for inference so the Streamlit server keeps some headroom
+NUM_THREADS = max(1, (os.cpu_count() or 1) // 2)
+tf.config.threading.set_intra_op_parallelism_threads(NUM_THREADS)
+tf.config.threading.set_inter_op_parallelism_threads(1)  # Single-image inference has no independent ops to overlap
 
 # Set the page configuration with favicon
 st.set_page_config(
@@ -67,6 +77,54 @@ def load_model():
 
 model = load_model()
 
+# Layers selectable with the sensitivity slider
+SENSITIVITY_LAYERS = tuple(range(1, 13))
+
+# Heatmap computed inside the model graph: channel mean, ReLU and 0-1 normalization per image
+def feature_map_to_cam(feature_map):
+    cam = tf.nn.relu(tf.reduce_mean(feature_map, axis=-1))
+    axes = list(range(1, len(cam.shape)))
+    return cam / (tf.reduce_max(cam, axis=axes, keepdims=True) + 1e-8)
+
+# Build one model exposing the heatmap of every selectable layer plus the prediction, packed into a single flat output
+@st.cache_resource
+def get_cam_model(_model):
+    # Imported here so keras' model-building API only loads when the cached model is first built
+    from keras.models import Model
+    from keras.layers import Concatenate, Flatten, Lambda
+
+    outputs = [Lambda(feature_map_to_cam)(_model.layers[layer].output) for layer in SENSITIVITY_LAYERS] + [_model.layers[-1].output]
+    packed = Concatenate()([Flatten()(output) for output in outputs])
+    return Model(inputs=_model.inputs, outputs=packed), [tuple(output.shape[1:]) for output in outputs]
+
+# Convert the packed heatmaps + prediction model to a float16 TFLite model for CPU inference
+@st.cache_resource
+def load_interpreter(_model):
+    cam_model, output_shapes = get_cam_model(_model)
+    converter = tf.lite.TFLiteConverter.from_keras_model(cam_model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.target_spec.supported_types = [tf.float16]  # float16 weights, float32 compute
+    # XNNPACK is the default CPU delegate; threads are set explicitly instead of TFLite's single thread
+    interpreter = tf.lite.Interpreter(model_content=converter.convert(), num_threads=NUM_THREADS,
+                                      experimental_op_resolver_type=tf.lite.experimental.OpResolverType.AUTO)
+    interpreter.allocate_tensors()
+    # The interpreter is shared by every session thread but is not thread-safe, so calls hold this lock
+    return interpreter, threading.Lock(), interpreter.get_input_details()[0]['index'], interpreter.get_output_details()[0]['index'], output_shapes
+
+# Run all selectable layers in one call and cache the heatmaps per image, so slider changes need no model call
+@st.cache_data(max_entries=8, show_spinner=False)
+def predict_heat_maps(_model, img_reshape):
+    interpreter, lock, input_index, output_index, output_shapes = load_interpreter(_model)
+    with lock:
+        interpreter.set_tensor(input_index, img_reshape)
+        interpreter.invoke()
+        packed = interpreter.get_tensor(output_index)[0]
+
+    # Unpack the flat output back into the per-layer heatmaps and the prediction
+    sizes = [math.prod(shape) for shape in output_shapes]
+    outputs = [part.reshape(shape) for part, shape in zip(np.split(packed, np.cumsum(sizes)[:-1]), output_shapes)]
+    return dict(zip(SENSITIVITY_LAYERS, outputs)), outputs[-1][np.newaxis, ...]
+
 # Sidebar for app information
 st.sidebar.header("About This App")
 st.sidebar.write("""This app uses a Convolutional Neural Network (CNN) model to detect brick walls and classify them as either normal, cracked, or not a wall. You can upload an image, and the app will analyze it to provide a prediction.""")
@@ -78,56 +136,83 @@ Talha Bin Tahir
 # Main area for image upload
 file = st.file_uploader("Please upload an image of the brick wall", type=("jpg", "png", "jpeg", "bmp", "tiff", "webp"))
 
+# EXIF tag id of 'Orientation', looked up once instead of on every upload
+ORIENTATION_TAG = next(tag for tag, name in ExifTags.TAGS.items() if name == 'Orientation')
+# Lossless transpose for each EXIF orientation value (cheaper than resampling with rotate)
+ORIENTATION_TRANSPOSE = {3: Image.Transpose.ROTATE_180, 6: Image.Transpose.ROTATE_270, 8: Image.Transpose.ROTATE_90}
+
 # Function to correct image orientation based on EXIF data
 def correct_orientation(image):
     try:
-        for orientation in ExifTags.TAGS.keys():
-            if ExifTags.TAGS[orientation] == 'Orientation':
-                break
         exif = image._getexif()
         if exif is not None:
-            orientation = exif.get(orientation, 1)
-            if orientation == 3:
-                image = image.rotate(180, expand=True)
-            elif orientation == 6:
-                image = image.rotate(270, expand=True)
-            elif orientation == 8:
-                image = image.rotate(90, expand=True)
+            transpose = ORIENTATION_TRANSPOSE.get(exif.get(ORIENTATION_TAG, 1))
+            if transpose is not None:
+                image = image.transpose(transpose)
     except (AttributeError, KeyError, IndexError):
         pass
     return image
     
+# Decode the upload and correct its orientation once per uploaded file instead of on every rerun
+@st.cache_data(max_entries=16, show_spinner=False)
+def decode_and_orient(file_bytes):
+    image = Image.open(io.BytesIO(file_bytes))
+    image.load()
+    return correct_orientation(image)
+
 # Adding Canvas Background
-def add_canvas(image, fill_color=(255, 255, 255)):
-    """Automatically adjusts canvas size according to image size, with added padding and centers the image on the canvas."""
-    # Get the original image size
-    image_width, image_height = image.size
+def add_canvas(image, fill_color=(255, 255, 255), border_size=0):
+    """Automatically adjusts canvas size according to image size, with added padding and an optional white border, and centers the image on the canvas."""
+    # Get the original image (PIL image or RGB array) as an RGB array
+    if isinstance(image, np.ndarray):
+        image_np = image
+    else:
+        image_np = np.asarray(image if image.mode == "RGB" else image.convert("RGB"))
+    
+    # Get the bordered image size
+    image_height = image_np.shape[0] + 2 * border_size
+    image_width = image_np.shape[1] + 2 * border_size
     
     # Calculate new canvas size with padding
     canvas_width = image_width + math.ceil(0.015 * image_width)
     canvas_height = image_height + math.ceil(0.07 * image_height)
     
-    # Create a new image (canvas) with the calculated size
-    canvas = Image.new("RGB", (canvas_width, canvas_height), fill_color)
+    # Create the canvas with the calculated size
+    canvas = np.full((canvas_height, canvas_width, 3), fill_color, dtype=np.uint8)
+    
+    # Calculate the position to paste the bordered image at the center of the canvas
+    left = (canvas_width - image_width) // 2
+    top = (canvas_height - image_height) // 7
     
-    # Calculate the position to paste the image at the center of the canvas
-    paste_position = (
-        (canvas_width - image_width) // 2,
-        (canvas_height - image_height) // 7
-    )
+    # The border only needs drawing when it differs from the canvas color
+    if border_size and tuple(fill_color) != (255, 255, 255):
+        canvas[top:top + image_height, left:left + image_width] = 255
     
-    # Paste the original image onto the canvas
-    canvas.paste(image, paste_position)
+    # Copy the original image inside the border
+    top += border_size
+    left += border_size
+    canvas[top:top + image_np.shape[0], left:left + image_np.shape[1]] = image_np
     
-    return canvas
+    return Image.fromarray(canvas)
+
 
+# Longest side used for contour drawing and the slider images; Streamlit never displays more than this
+MAX_PROCESSING_SIZE = 1600
+
+# Smallest contour area (in 224x224 model pixels) drawn as a crack region
+MIN_CONTOUR_AREA = 4
 
 # Function to localize the crack and to make predictions using the TensorFlow model
 def import_and_predict(image_data, model, sensitivity=11):
     try:
+        # Decode once (reused for contour drawing) and cap large uploads to the processing size
+        image_rgb = np.array(image_data if image_data.mode == "RGB" else image_data.convert("RGB"))  # No extra copy for RGB uploads
+        if max(image_rgb.shape[:2]) > MAX_PROCESSING_SIZE:
+            cap_scale = MAX_PROCESSING_SIZE / max(image_rgb.shape[:2])
+            image_rgb = cv2.resize(image_rgb, None, fx=cap_scale, fy=cap_scale, interpolation=cv2.INTER_AREA)
+        
         # Get original image size
-        original_size = image_data.size  # (width, height)
-        original_width, original_height = original_size
+        original_height, original_width = image_rgb.shape[:2]
         size = (224, 224)  # Model input size
         
         # Calculate the maximum dimension of the original image
@@ -138,83 +223,79 @@ def import_and_predict(image_data, model, sensitivity=11):
         
        
         # Resize the image while maintaining aspect ratio, then pad it to 224x224
-        image_resized = image_data.convert("RGB")
-        image_resized = ImageOps.fit(image_resized, size, Image.LANCZOS)  # Exact resize to 224x224
+        scale = min(size[0] / original_width, size[1] / original_height)
+        resized_width = max(1, round(original_width * scale))
+        resized_height = max(1, round(original_height * scale))
+        interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR  # INTER_AREA only pays off when downscaling
+        image_resized = cv2.resize(image_rgb, (resized_width, resized_height), interpolation=interpolation)
+        pad_x, pad_y = size[0] - resized_width, size[1] - resized_height
+        image_resized = cv2.copyMakeBorder(image_resized, pad_y // 2, pad_y - pad_y // 2, pad_x // 2, pad_x - pad_x // 2,
+                                           cv2.BORDER_CONSTANT, value=(0, 0, 0))
         
-        # Optionally pad instead of stretching (preserving aspect ratio)
-        image_resized = ImageOps.pad(image_data.convert("RGB"), size, method=Image.LANCZOS)
-        
-        img = np.asarray(image_resized).astype(np.float32) / 255.0
+        img = np.multiply(image_resized, np.float32(1.0 / 255.0), dtype=np.float32)  # Cast and scale in one pass
         img_reshape = img[np.newaxis, ...]  # Ensure the shape is (1, 224, 224, 3)
         
-        # Get predictions from the model
-        custom_model = Model(inputs=model.inputs, 
-                             outputs=(model.layers[sensitivity].output, model.layers[-1].output))
-        layer_output, pred_vec = custom_model.predict(img_reshape)
+        # Get the heatmaps of all selectable layers and the predictions from the TFLite model
+        heat_maps, pred_vec = predict_heat_maps(model, img_reshape)
         
         # Get the predicted class and confidence
-        pred = np.argmax(pred_vec)
+        pred = int(np.argmax(pred_vec))
         
-        # Extract the feature map output
-        layer_output = np.squeeze(layer_output)  # Shape varies based on the layer
+        # Add white borders and the canvas background for the comparison slider
+        border_size = 10  # Set the border size
+        image_with_border = add_canvas(image_rgb, border_size=border_size)
         
-        # Average across the depth dimension to generate the heatmap
-        heat_map = np.mean(layer_output, axis=-1)  # Shape depends on the layer
+        # Crack localization is only shown for cracked walls, so skip the contour work otherwise
+        if pred != 1:
+            return pred_vec, image_with_border, image_with_border, image_data
         
-        # Normalize the heatmap between 0 and 1 for better visualization
-        heat_map = np.maximum(heat_map, 0)  # ReLU to eliminate negative values
-        heat_map /= np.max(heat_map)  # Normalize to 0-1
+        # Pick the heatmap of the selected layer
+        heat_map = heat_maps[sensitivity]  # Shape depends on the layer
         
-        # Resize heatmap to the size of the resized image
+        # Scale the 0-1 heatmap to 0-255 uint8 for better visualization
+        heat_map = cv2.convertScaleAbs(heat_map, alpha=255)
+        
+        # Resize the uint8 heatmap to the size of the resized image
         heatmap_resized = cv2.resize(heat_map, (img.shape[1], img.shape[0]), interpolation=cv2.INTER_LINEAR)
         
         # Threshold the heatmap to get regions of interest
-        _, thresh_map = cv2.threshold(np.uint8(255 * heatmap_resized), 50, 255, cv2.THRESH_BINARY)
+        _, thresh_map = cv2.threshold(heatmap_resized, 50, 255, cv2.THRESH_BINARY)
         
         # Find contours in the thresholded heatmap
-        contours, _ = cv2.findContours(thresh_map, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        
-        # Convert original image to numpy array (for contour drawing)
-        original_img_np = np.array(image_data)
-        
-        # Ensure the original image is in 3 channels (RGB) for contour drawing
-        if len(original_img_np.shape) == 2:  # If grayscale, convert to RGB
-            original_img_np = cv2.cvtColor(original_img_np, cv2.COLOR_GRAY2RGB)
-        
-        # Draw contours on the original image, but scale contours to the original size
-        original_img_bgr = cv2.cvtColor(original_img_np, cv2.COLOR_RGB2BGR)
+        # (Teh-Chin approximation keeps fewer points per contour; tiny noise blobs are dropped before scaling)
+        contours, _ = cv2.findContours(thresh_map, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_TC89_KCOS)
+        contours = [contour for contour in contours if cv2.contourArea(contour) > MIN_CONTOUR_AREA]
         
         # Compute the scaling factor for width and height separately
-        scale_x = original_width / image_resized.size[0]
-        scale_y = original_height / image_resized.size[1]
+        scale_x = original_width / size[0]
+        scale_y = original_height / size[1]
         
         # Adjust the scaling more precisely based on aspect ratio consistency
         def scale_contours(contours, scale_x, scale_y):
-            scaled_contours = []
-            for contour in contours:
-                scaled_contour = np.array([[int(point[0][0] * scale_x), int(point[0][1] * scale_y)] for point in contour])
-                scaled_contours.append(scaled_contour)
-            return scaled_contours
+            if not contours:
+                return []
+            scale = np.array([scale_x, scale_y], dtype=np.float32)
+            # Scale all (N, 1, 2) contours stacked in one multiply, then split back into the list cv2 expects
+            stacked = np.concatenate(contours, axis=0).astype(np.float32)
+            stacked *= scale
+            stacked = np.rint(stacked).astype(np.int32)
+            lengths = np.fromiter((len(contour) for contour in contours), dtype=np.int64, count=len(contours))
+            return np.split(stacked, np.cumsum(lengths)[:-1])
         
         scaled_contours = scale_contours(contours, scale_x, scale_y)
         
-        # Draw scaled contours on the original image (in blue BGR: (255, 0, 0))
-        cv2.drawContours(original_img_bgr, scaled_contours, -1, (255, 0, 0), 5)  # Blue contours
-        
-        # Convert the image back to RGB
-        contours_img_rgb = cv2.cvtColor(original_img_bgr, cv2.COLOR_BGR2RGB)
+        # Draw scaled contours directly on the RGB original image (in blue RGB: (0, 0, 255))
+        contours_img_rgb = image_rgb
+        cv2.drawContours(contours_img_rgb, scaled_contours, -1, (0, 0, 255), 5)  # Blue contours
         
         # Convert to a PIL Image for display in Streamlit
         contours_pil2 = Image.fromarray(contours_img_rgb)
         
         # --- Apply Brightness or Contrast Enhancement ---
-        enhancer = ImageEnhance.Brightness(contours_pil2)
-        contours_pil = enhancer.enhance(0.8)  # 0.8 to darken, 1.2 to lighten
+        contours_pil = Image.fromarray(cv2.convertScaleAbs(contours_img_rgb, alpha=0.8, beta=0))  # 0.8 to darken, 1.2 to lighten
         
-        # Add white borders
-        border_size = 10  # Set the border size
-        image_with_border = add_white_border(image_data, border_size)
-        contours_with_border = add_white_border(contours_pil, border_size)
+        # Add white border and canvas to the localization image
+        contours_with_border = add_canvas(contours_pil, border_size=border_size)
         
         return pred_vec, image_with_border, contours_with_border, contours_pil2
 
@@ -223,11 +304,11 @@ def import_and_predict(image_data, model, sensitivity=11):
         st.error(f"An error occurred during prediction: {e}")
         return None, None
         
-# Adds border to the image
-
-def add_white_border(image, border_size):
-    """Add a white border to the image."""
-    return ImageOps.expand(image, border= border_size, fill=(255, 255, 255))
+# Cache the results per uploaded file and sensitivity, so reruns from other widgets skip all the work
+# (bounded: a full slider sweep of one upload plus a few recent uploads)
+@st.cache_data(max_entries=16, show_spinner=False)
+def cached_predict(_image_data, image_key, sensitivity=11):
+    return import_and_predict(_image_data, model, sensitivity=sensitivity)
 
 # Check if a file was uploaded
 if file is None:
@@ -235,18 +316,19 @@ if file is None:
 else:
     with st.spinner("Processing image..."):
         try:
-            # Try to open the uploaded image using PIL
-            image = Image.open(file)
+            # Try to open the uploaded image using PIL and correct the orientation if necessary
+            file_bytes = file.getvalue()
+            image = decode_and_orient(file_bytes)
             if image is None:
                 raise ValueError("Uploaded file is not a valid image.")
-            
-            # Correct the orientation if necessary
-            image = correct_orientation(image)
+
+            # Key the cached results on the uploaded bytes
+            image_key = hashlib.blake2b(file_bytes, digest_size=16).hexdigest()
 
             
             
             # Perform prediction
-            predictions, image_with_border, contours_with_border, contours_pil2 = import_and_predict(image, model)
+            predictions, image_with_border, contours_with_border, contours_pil2 = cached_predict(image, image_key)
             
             if predictions is not None:
                 predicted_class = np.argmax(predictions)
@@ -281,14 +363,14 @@ else:
                     # Add a slider for selecting the sensitivity dynamically
                     sensitivity = st.slider(
                         "Adjust Detection Sensitivity (Higher values increase detection sensitivity)",
-                        min_value=1,   # Minimum value for sensitivity
-                        max_value=12,   # Maximum value for sensitivity
+                        min_value=SENSITIVITY_LAYERS[0],   # Minimum value for sensitivity
+                        max_value=SENSITIVITY_LAYERS[-1],   # Maximum value for sensitivity
                         value=11,       # Default value for sensitivity
                         step=1,        # Step for incremental changes
                         format="%.1f"    # Format to display sensitivity with one decimal
                                             )
                 # Perform prediction again
-                predictions, image_with_border, contours_with_border, contours_pil2 = import_and_predict(image, model, sensitivity=sensitivity)
+                predictions, image_with_border, contours_with_border, contours_pil2 = cached_predict(image, image_key, sensitivity=sensitivity)
 
                 # Display the uploaded image and the contours side by side
                 col1, col2 = st.columns(2)
@@ -307,13 +389,14 @@ else:
 
                
                 
-                image_with_border = add_canvas(image_with_border)
-                contours_with_border = add_canvas(contours_with_border)               
                 # st.write(f"Normal Wall: {prediction_percentages[0]:.2f}%")
                 # st.write(f"Cracked Wall: {prediction_percentages[1]:.2f}%")
                 # st.write(f"Not a Wall: {prediction_percentages[2]:.2f}%")
                 st.write("")  # Creates a blank line
                 if st.checkbox("Original vs Cracked Slider"):
+                        # Imported here so the component only loads once the slider is requested
+                        from streamlit_image_comparison import image_comparison
+
                         # Conditionally display image comparison
                         if predicted_class == 1:
                             image_comparison(
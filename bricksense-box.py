@@ -2,19 +2,53 @@ import streamlit as st
 from PIL import Image
 import numpy as np
 import cv2
-import matplotlib.pyplot as plt
+import os
+import threading
+# CPU-only host: hide CUDA devices and silence TensorFlow start-up logs before it is imported
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")
+os.environ.setdefault("TF_CPP_MIN_LOG_LEVEL", "3")
 import tensorflow as tf
-from keras.models import Model
+
+# Use half the cores for inference so the Streamlit server keeps some headroom
+NUM_THREADS = max(1, (os.cpu_count() or 1) // 2)
+tf.config.threading.set_intra_op_parallelism_threads(NUM_THREADS)
+tf.config.threading.set_inter_op_parallelism_threads(1)  # Single-image inference has no independent ops to overlap
 
 # Streamlit app title
 st.title("Brick Wall Crack Detection")
 
 # Load the pre-trained model
 model_path = '170kmodelv3_version_cam_1.keras'
-model = tf.keras.models.load_model(model_path)
 
-# Define a new model that outputs feature maps and prediction
-custom_model = Model(inputs=model.inputs, outputs=(model.layers[10].output, model.layers[-1].output))
+# Convert the feature maps + prediction model to a float16 TFLite interpreter once per server process
+@st.cache_resource
+def load_tflite(model_path):
+    # Imported here so keras' model-building API only loads when the cached model is first built
+    from keras.models import Model
+
+    model = tf.keras.models.load_model(model_path)
+
+    # Define a new model that outputs feature maps and prediction
+    custom_model = Model(inputs=model.inputs, outputs=(model.layers[10].output, model.layers[-1].output))
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(custom_model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.target_spec.supported_types = [tf.float16]  # float16 weights, float32 compute
+    interpreter = tf.lite.Interpreter(model_content=converter.convert(), num_threads=NUM_THREADS)
+    interpreter.allocate_tensors()
+
+    # TFLite does not keep the Keras output order, so match the outputs by shape
+    output_index = {tuple(int(d) for d in detail['shape'][1:]): detail['index'] for detail in interpreter.get_output_details()}
+    output_indices = tuple(output_index[tuple(output.shape[1:])] for output in custom_model.outputs)
+    # The interpreter is shared by every session thread but is not thread-safe, so calls hold this lock
+    return interpreter, threading.Lock(), interpreter.get_input_details()[0]['index'], output_indices
+
+interpreter, interpreter_lock, input_index, output_indices = load_tflite(model_path)
+
+# Structuring elements for outlining the thresholded crack regions: 1 px outside and 2 px inside the boundary,
+# the same 3 px band that drawContours draws at thickness 2
+EDGE_OUTER_KERNEL = np.ones((3, 3), np.uint8)
+EDGE_INNER_KERNEL = np.ones((5, 5), np.uint8)
 
 # Class dictionary
 class_dict = {
@@ -38,45 +72,42 @@ else:
     # st.image(img, caption="Uploaded Image", use_column_width=True)
 
     # Preprocess the image for prediction
-    img_tensor = np.expand_dims(img, axis=0) / 255.0
+    img_tensor = np.multiply(img[np.newaxis, ...], np.float32(1.0 / 255.0), dtype=np.float32)  # Cast and scale in one pass
     preprocessed_img = img_tensor
 
     # Get the conv2d_3 output and the predictions
-    conv2d_3_output, pred_vec = custom_model.predict(preprocessed_img)
+    with interpreter_lock:
+        interpreter.set_tensor(input_index, preprocessed_img)
+        interpreter.invoke()
+        conv2d_3_output, pred_vec = (interpreter.get_tensor(index) for index in output_indices)
     conv2d_3_output = np.squeeze(conv2d_3_output)
 
     # Prediction for the image
     pred = np.argmax(pred_vec)
 
-    # Resize the conv2d_3 output
-    upsampled_conv2d_3_output = cv2.resize(conv2d_3_output, (img.shape[1], img.shape[0]), interpolation=cv2.INTER_LINEAR)
-
-    # Generate heatmap
-    heat_map = np.mean(upsampled_conv2d_3_output, axis=-1)
-    heat_map = np.maximum(heat_map, 0)
-    heat_map = heat_map / heat_map.max()
+    # Generate heatmap (average the filters before resizing; the mean commutes with the linear resize)
+    heat_map = conv2d_3_output.mean(axis=-1, dtype=np.float32)
+    max_value = heat_map.max()
+    if max_value > 0:
+        heat_map *= np.float32(255.0 / max_value)  # Scale on the small 7x7 map; linear, so the resize keeps it within 0-255
+    heat_map = cv2.resize(heat_map, (img.shape[1], img.shape[0]), interpolation=cv2.INTER_LINEAR)
+    np.maximum(heat_map, 0, out=heat_map)  # ReLU after the resize, since it does not commute with interpolation
 
     # Threshold the heatmap to get the regions with the highest activation
     threshold = 0.5
-    heat_map_thresh = np.uint8(255 * heat_map)
+    heat_map_thresh = cv2.convertScaleAbs(heat_map)
     _, thresh_map = cv2.threshold(heat_map_thresh, int(255 * threshold), 255, cv2.THRESH_BINARY)
 
-    # Find contours in the thresholded heatmap
-    contours, _ = cv2.findContours(thresh_map, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    # Outline the thresholded regions with a dilate/erode difference (3 px wide) instead of tracing contours
+    # (unlike the external contours it also outlines holes inside a region)
+    edge_mask = cv2.subtract(cv2.dilate(thresh_map, EDGE_OUTER_KERNEL), cv2.erode(thresh_map, EDGE_INNER_KERNEL))
 
-    # Draw contours on the original image
+    # Draw the outlines on the original image
     contoured_img_only = img.copy()
-    cv2.drawContours(contoured_img_only, contours, -1, (0, 255, 0), 2)
+    contoured_img_only[edge_mask > 0] = (0, 255, 0)
 
     # Fetch the class name for the prediction
     predicted_class = class_dict[pred]
 
     # Display the image with contours and predicted class
     st.image(contoured_img_only, caption=f"Predicted Class: {predicted_class}", use_column_width=True)
-
-    # Optionally, you can add heatmap visualization
-    fig, ax = plt.subplots()
-    ax.imshow(img)
-    ax.imshow(heat_map, cmap='jet', alpha=0.4)
-    ax.set_title("Heatmap")
-    # st.pyplot(fig)
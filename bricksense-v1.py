@@ -1,10 +1,20 @@
 import streamlit as st
-from PIL import Image, ImageOps, ExifTags
+from PIL import Image, ExifTags
 import numpy as np
+import io
+import math
+import os
+import threading
+# CPU-only host: hide CUDA devices and silence TensorFlow start-up logs before it is imported
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")
+os.environ.setdefault("TF_CPP_MIN_LOG_LEVEL", "3")
 import tensorflow as tf
 import cv2
-from keras.models import Model
-import matplotlib.pyplot as plt
+
+# Use half the cores for inference so the Streamlit server keeps some headroom
+NUM_THREADS = max(1, (os.cpu_count() or 1) // 2)
+tf.config.threading.set_intra_op_parallelism_threads(NUM_THREADS)
+tf.config.threading.set_inter_op_parallelism_threads(1)  # Single-image inference has no independent ops to overlap
 
 @st.cache_resource
 def load_model():
@@ -17,74 +27,119 @@ def load_model():
 
 model = load_model()
 
+# Heatmap computed inside the model graph: channel mean, ReLU and 0-1 normalization per image
+def feature_map_to_cam(feature_map):
+    cam = tf.nn.relu(tf.reduce_mean(feature_map, axis=-1))
+    axes = list(range(1, len(cam.shape)))
+    return cam / (tf.reduce_max(cam, axis=axes, keepdims=True) + 1e-8)
+
+# Layers selectable with the layer index slider
+SELECTABLE_LAYERS = tuple(range(6, len(model.layers) - 3)) if model is not None else ()
+
+# Build one model exposing the heatmap of every selectable layer plus the prediction, packed into a single flat output
+@st.cache_resource
+def get_cam_model(_model):
+    # Imported here so keras' model-building API only loads when the cached model is first built
+    from keras.models import Model
+    from keras.layers import Concatenate, Flatten, Lambda
+
+    outputs = [Lambda(feature_map_to_cam)(_model.layers[layer].output) for layer in SELECTABLE_LAYERS] + [_model.layers[-1].output]
+    packed = Concatenate()([Flatten()(output) for output in outputs])
+    return Model(inputs=_model.inputs, outputs=packed), [tuple(output.shape[1:]) for output in outputs]
+
+# Convert the packed heatmaps + prediction model to a float16 TFLite model once, so slider changes need no conversion
+@st.cache_resource
+def load_interpreter(_model):
+    cam_model, output_shapes = get_cam_model(_model)
+    converter = tf.lite.TFLiteConverter.from_keras_model(cam_model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.target_spec.supported_types = [tf.float16]  # float16 weights, float32 compute
+    # XNNPACK is the default CPU delegate; threads are set explicitly instead of TFLite's single thread
+    interpreter = tf.lite.Interpreter(model_content=converter.convert(), num_threads=NUM_THREADS,
+                                      experimental_op_resolver_type=tf.lite.experimental.OpResolverType.AUTO)
+    interpreter.allocate_tensors()
+    # The interpreter is shared by every session thread but is not thread-safe, so calls hold this lock
+    return interpreter, threading.Lock(), interpreter.get_input_details()[0]['index'], interpreter.get_output_details()[0]['index'], output_shapes
+
+# EXIF tag id of 'Orientation', looked up once instead of on every upload
+ORIENTATION_TAG = next(tag for tag, name in ExifTags.TAGS.items() if name == 'Orientation')
+# Lossless transpose for each EXIF orientation value (cheaper than resampling with rotate)
+ORIENTATION_TRANSPOSE = {3: Image.Transpose.ROTATE_180, 6: Image.Transpose.ROTATE_270, 8: Image.Transpose.ROTATE_90}
+
 def correct_orientation(image):
     try:
         if hasattr(image, '_getexif'):
-            for orientation in ExifTags.TAGS.keys():
-                if ExifTags.TAGS[orientation] == 'Orientation':
-                    break
             exif = image._getexif()
             if exif is not None:
-                orientation = exif.get(orientation, 1)
-                if orientation == 3:
-                    image = image.rotate(180, expand=True)
-                elif orientation == 6:
-                    image = image.rotate(270, expand=True)
-                elif orientation == 8:
-                    image = image.rotate(90, expand=True)
+                transpose = ORIENTATION_TRANSPOSE.get(exif.get(ORIENTATION_TAG, 1))
+                if transpose is not None:
+                    image = image.transpose(transpose)
     except Exception as e:
         st.error(f"Error correcting orientation: {e}")
     return image
 
+# Longest side used for contour drawing and the displayed result; Streamlit never displays more than this
+MAX_PROCESSING_SIZE = 1600
+
+# Smallest contour area (in 224x224 model pixels) drawn as a crack region
+MIN_CONTOUR_AREA = 4
+
 def import_and_predict(image_data, model, layer_index=11):
     try:
+        # The caller passes the upload already decoded to an RGB uint8 array (reused for contour drawing)
+        image_rgb = image_data
+        # Cap large uploads to the processing size
+        if max(image_rgb.shape[:2]) > MAX_PROCESSING_SIZE:
+            cap_scale = MAX_PROCESSING_SIZE / max(image_rgb.shape[:2])
+            image_rgb = cv2.resize(image_rgb, None, fx=cap_scale, fy=cap_scale, interpolation=cv2.INTER_AREA)
+
         # Get original image size
-        original_size = image_data.size  # (width, height)
-        original_width, original_height = original_size
+        original_height, original_width = image_rgb.shape[:2]
         size = (224, 224)  # Model input size
 
-        # Resize the image for model prediction
-        image_resized = image_data.convert("RGB")
-        image_resized = ImageOps.fit(image_resized, size, Image.LANCZOS)
-        img = np.asarray(image_resized).astype(np.float32) / 255.0
+        # Center-crop to the model aspect ratio, then resize for model prediction
+        crop_width = min(original_width, round(original_height * size[0] / size[1]))
+        crop_height = min(original_height, round(original_width * size[1] / size[0]))
+        left = (original_width - crop_width) // 2
+        top = (original_height - crop_height) // 2
+        interpolation = cv2.INTER_AREA if crop_width > size[0] else cv2.INTER_LINEAR  # INTER_AREA only pays off when downscaling
+        image_resized = cv2.resize(image_rgb[top:top + crop_height, left:left + crop_width], size, interpolation=interpolation)
+        img = np.multiply(image_resized, np.float32(1.0 / 255.0), dtype=np.float32)  # Cast and scale in one pass
         img_reshape = img[np.newaxis, ...]
 
-        # Get predictions from the model
-        custom_model = Model(inputs=model.inputs, 
-                             outputs=(model.layers[layer_index].output, model.layers[-1].output))
-        layer_output, pred_vec = custom_model.predict(img_reshape)
+        # Get predictions from the TFLite model
+        interpreter, lock, input_index, output_index, output_shapes = load_interpreter(model)
+        with lock:
+            interpreter.set_tensor(input_index, img_reshape)
+            interpreter.invoke()
+            packed = interpreter.get_tensor(output_index)[0]
 
-        # Get the predicted class and confidence
-        pred = np.argmax(pred_vec)
+        # Unpack the flat output back into the per-layer heatmaps and the prediction
+        sizes = [math.prod(shape) for shape in output_shapes]
+        outputs = [part.reshape(shape) for part, shape in zip(np.split(packed, np.cumsum(sizes)[:-1]), output_shapes)]
+        heat_map = outputs[SELECTABLE_LAYERS.index(layer_index)]
+        pred_vec = outputs[-1][np.newaxis, ...]
 
-        # Extract the feature map output
-        layer_output = np.squeeze(layer_output)  # Shape varies based on the layer
+        # The class is computed once here and returned, so the caller does not recompute it
+        predicted_class = int(np.argmax(pred_vec))
 
-        # Average across the depth dimension to generate the heatmap
-        heat_map = np.mean(layer_output, axis=-1)  # Shape depends on the layer
+        # Contours are only shown for cracked walls, so skip the contour work otherwise
+        if predicted_class != 1:
+            return pred_vec, predicted_class, image_data
 
-        # Normalize the heatmap between 0 and 1 for better visualization
-        heat_map = np.maximum(heat_map, 0)  # ReLU to eliminate negative values
-        heat_map /= np.max(heat_map)  # Normalize to 0-1
+        # Scale the 0-1 heatmap of the image to 0-255 uint8 for better visualization
+        heat_map = cv2.convertScaleAbs(heat_map, alpha=255)  # Shape depends on the layer
 
-        # Resize heatmap to the size of the resized image (224, 224)
+        # Resize the uint8 heatmap to the size of the resized image (224, 224)
         heatmap_resized = cv2.resize(heat_map, size, interpolation=cv2.INTER_LINEAR)
 
         # Threshold the heatmap to get regions of interest
-        _, thresh_map = cv2.threshold(np.uint8(255 * heatmap_resized), 127, 255, cv2.THRESH_BINARY)
+        _, thresh_map = cv2.threshold(heatmap_resized, 127, 255, cv2.THRESH_BINARY)
 
         # Find contours in the thresholded heatmap
-        contours, _ = cv2.findContours(thresh_map, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-        # Convert original image to numpy array (for contour drawing)
-        original_img_np = np.array(image_data)
-
-        # Ensure the original image is in 3 channels (RGB) for contour drawing
-        if len(original_img_np.shape) == 2:  # If grayscale, convert to RGB
-            original_img_np = cv2.cvtColor(original_img_np, cv2.COLOR_GRAY2RGB)
-
-        # Draw contours on the original image, but scale contours to the original size
-        original_img_bgr = cv2.cvtColor(original_img_np, cv2.COLOR_RGB2BGR)
+        # (Teh-Chin approximation keeps fewer points per contour; tiny noise blobs are dropped before scaling)
+        contours, _ = cv2.findContours(thresh_map, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_TC89_KCOS)
+        contours = [contour for contour in contours if cv2.contourArea(contour) > MIN_CONTOUR_AREA]
 
         # Scale contours back to original image size
         scale_x = original_width / size[0]
@@ -92,27 +147,30 @@ def import_and_predict(image_data, model, layer_index=11):
         
         # Adjust the scaling more precisely based on aspect ratio consistency
         def scale_contours(contours, scale_x, scale_y):
-            scaled_contours = []
-            for contour in contours:
-                scaled_contour = np.array([[int(point[0][0] * scale_x), int(point[0][1] * scale_y)] for point in contour])
-                scaled_contours.append(scaled_contour)
-            return scaled_contours
+            if not contours:
+                return []
+            scale = np.array([scale_x, scale_y], dtype=np.float32)
+            # Scale all (N, 1, 2) contours stacked in one multiply, then split back into the list cv2 expects
+            stacked = np.concatenate(contours, axis=0).astype(np.float32)
+            stacked *= scale
+            stacked = np.rint(stacked).astype(np.int32)
+            lengths = np.fromiter((len(contour) for contour in contours), dtype=np.int64, count=len(contours))
+            return np.split(stacked, np.cumsum(lengths)[:-1])
 
         scaled_contours = scale_contours(contours, scale_x, scale_y)
 
-        # Draw scaled contours on the original image (in blue BGR: (255, 0, 0))
-        cv2.drawContours(original_img_bgr, scaled_contours, -1, (255, 0, 0), 2)  # Blue contours
-
-        # Convert the image back to RGB
-        contours_img_rgb = cv2.cvtColor(original_img_bgr, cv2.COLOR_BGR2RGB)
+        # Draw scaled contours on the RGB original image (in blue RGB: (0, 0, 255)),
+        # copying first when no downscale happened so the caller's array is left untouched
+        contours_img_rgb = image_rgb.copy() if image_rgb is image_data else image_rgb
+        cv2.drawContours(contours_img_rgb, scaled_contours, -1, (0, 0, 255), 2)  # Blue contours
 
         # Convert to a PIL Image for display in Streamlit
         contours_pil = Image.fromarray(contours_img_rgb)
 
-        return pred_vec, contours_pil
+        return pred_vec, predicted_class, contours_pil
     except Exception as e:
         st.error(f"An error occurred during prediction: {e}")
-        return None, None
+        return None, None, None
 
 # Main area for image upload
 file = st.file_uploader("Please upload an image of the brick wall", type=["jpg", "png", "jpeg", "bmp", "tiff", "webp"])
@@ -123,18 +181,20 @@ if file is None:
 else:
     with st.spinner("Processing image..."):
         try:
-            # Try to open the uploaded image using PIL
-            image = Image.open(file)
+            # Try to open the uploaded image using PIL, decoding it from memory once
+            image = Image.open(io.BytesIO(file.getvalue()))
+            image.load()
             if image is None:
                 raise ValueError("Uploaded file is not a valid image.")
 
-            # Correct the orientation if necessary
-            image = correct_orientation(image)
-
-            # Ensure the image format is valid
+            # Ensure the image format is valid (before orientation correction, whose transposed copy has no format)
             if image.format not in ["JPEG", "PNG", "BMP", "TIFF", "WEBP"]:
                 raise ValueError("Unsupported image format. Please upload JPG, PNG, BMP, TIFF, or WEBP files.")
 
+            # Correct the orientation if necessary, then hand a single RGB array to display and prediction
+            image = correct_orientation(image)
+            image = np.array(image if image.mode == "RGB" else image.convert("RGB"))
+
             # Display the uploaded image and the contours side by side
             col1, col2 = st.columns(2)
 
@@ -142,18 +202,18 @@ else:
                 st.image(image, caption="Uploaded Image", use_column_width=True)
 
             # Add a slider for selecting the layer index dynamically
-            layer_index = st.slider("Select layer index for feature extraction", min_value=6, max_value=len(model.layers)-4, value=10)
+            layer_index = st.slider("Select layer index for feature extraction", min_value=SELECTABLE_LAYERS[0], max_value=SELECTABLE_LAYERS[-1], value=10)
 
             # Perform prediction
-            predictions, contours_pil = import_and_predict(image, model, layer_index)
+            predictions, predicted_class, contours_pil = import_and_predict(image, model, layer_index)
             if predictions is not None:
-                predicted_class = np.argmax(predictions)
                 prediction_percentages = predictions[0] * 100
 
-                st.write(f"**Prediction Percentages:**")
-                st.write(f"Normal Wall: {prediction_percentages[0]:.2f}%")
-                st.write(f"Cracked Wall: {prediction_percentages[1]:.2f}%")
-                st.write(f"Not a Wall: {prediction_percentages[2]:.2f}%")
+                # Write the percentages in one element (trailing double spaces keep the line breaks)
+                st.markdown(f"""**Prediction Percentages:**  
+Normal Wall: {prediction_percentages[0]:.2f}%  
+Cracked Wall: {prediction_percentages[1]:.2f}%  
+Not a Wall: {prediction_percentages[2]:.2f}%""")
 
                 with col2:
                     if predicted_class == 1:
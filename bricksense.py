@@ -1,16 +1,22 @@
 import streamlit as st
+import os
+# CPU-only host: hide CUDA devices and silence TensorFlow start-up logs before it is imported
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")
+os.environ.setdefault("TF_CPP_MIN_LOG_LEVEL", "3")
 import tensorflow as tf
 from PIL import Image, ImageOps, ExifTags, ImageEnhance
 import numpy as np
 import cv2
-from keras.models import Model
-from streamlit_image_comparison import image_comparison
 import math
-import matplotlib.cm as cm
-import matplotlib.pyplot as plt
-# import io
+import io
+import hashlib
 # import base64
 
+# Use half the cores for inference so the Streamlit server keeps some headroom
+NUM_THREADS = max(1, (os.cpu_count() or 1) // 2)
+tf.config.threading.set_intra_op_parallelism_threads(NUM_THREADS)
+tf.config.threading.set_inter_op_parallelism_threads(1)  # Single-image inference has no independent ops to overlap
+
 # Set the page configuration with favicon
 st.set_page_config(
     page_title="Brick Detection",
@@ -93,6 +99,27 @@ def load_model():
         return None
 
 model = load_model()
+
+# Build the feature map + prediction model once per sensitivity and XLA-compile its fixed-shape forward pass
+@st.cache_resource
+def get_cam_infer(sensitivity):
+    # Imported here so keras' model-building API only loads when the cached model is first built
+    from keras.models import Model
+
+    custom_model = Model(inputs=model.inputs, 
+                         outputs=(model.layers[sensitivity].output, model.layers[-1].output))  # `conv2d_3` and predictions
+
+    # The uint8 -> 0-1 float normalization runs inside the compiled graph, fused with the first layer
+    @tf.function(jit_compile=True, input_signature=[tf.TensorSpec((1, 224, 224, 3), tf.uint8)])
+    def infer(x):
+        return custom_model(tf.cast(x, tf.float32) * (1.0 / 255.0), training=False)
+
+    # Trace once here so requests call the concrete function directly
+    return infer.get_concrete_function()
+
+# Build the default-sensitivity model at load time rather than on the first upload
+if model is not None:
+    get_cam_infer(9)
 #__________________________________________________________________________________________________________________________________________________________________________________
 
 # Sidebar for app information
@@ -106,25 +133,33 @@ Talha Bin Tahir
 # Main area for image upload
 file = st.file_uploader("Please upload an image of the brick wall", type=("jpg", "png", "jpeg", "bmp", "tiff", "webp"))
 
+# EXIF tag id of 'Orientation', looked up once instead of on every upload
+ORIENTATION_TAG = next(tag for tag, name in ExifTags.TAGS.items() if name == 'Orientation')
+# Lossless transpose for each EXIF orientation value (cheaper than resampling with rotate)
+ORIENTATION_TRANSPOSE = {3: Image.Transpose.ROTATE_180, 6: Image.Transpose.ROTATE_270, 8: Image.Transpose.ROTATE_90}
+
 # Function to correct image orientation based on EXIF data
 def correct_orientation(image):
     try:
-        for orientation in ExifTags.TAGS.keys():
-            if ExifTags.TAGS[orientation] == 'Orientation':
-                break
         exif = image._getexif()
         if exif is not None:
-            orientation = exif.get(orientation, 1)
-            if orientation == 3:
-                image = image.rotate(180, expand=True)
-            elif orientation == 6:
-                image = image.rotate(270, expand=True)
-            elif orientation == 8:
-                image = image.rotate(90, expand=True)
+            transpose = ORIENTATION_TRANSPOSE.get(exif.get(ORIENTATION_TAG, 1))
+            if transpose is not None:
+                image = image.transpose(transpose)
     except (AttributeError, KeyError, IndexError):
         pass
     return image
     
+# Decode the upload and correct its orientation once per uploaded file instead of on every rerun
+@st.cache_data(max_entries=16, show_spinner=False)
+def decode_and_orient(file_bytes):
+    image = Image.open(io.BytesIO(file_bytes))
+    image.load()
+    return correct_orientation(image)
+
+# RGB JET colormap for 0-255 heatmap values, built once (cv2's table is BGR, so reverse the channels)
+JET_LUT = cv2.applyColorMap(np.arange(256, dtype=np.uint8)[:, np.newaxis], cv2.COLORMAP_JET).reshape(256, 3)[:, ::-1].copy()
+
 # Adding Canvas Background
 def add_canvas(image, fill_color=(255, 255, 255)):
     """Automatically adjusts canvas size according to image size, with added padding and centers the image on the canvas."""
@@ -153,12 +188,9 @@ def add_canvas(image, fill_color=(255, 255, 255)):
 # Function to localize the crack and to make predictions using the TensorFlow model
 def import_and_predict(image_data, sensitivity=9):
     try:
-        # Convert image to numpy array
-        original_img = np.array(image_data)
-
-        # Convert image to RGB if it has an alpha channel
-        if original_img.shape[-1] == 4:  # Check if the image has 4 channels
-            original_img = cv2.cvtColor(original_img, cv2.COLOR_RGBA2RGB)
+        # Convert image to an RGB numpy array, deciding the conversion from the PIL mode up front
+        # (covers RGBA, grayscale and palette uploads without any cvtColor pass)
+        original_img = np.array(image_data if image_data.mode == "RGB" else image_data.convert("RGB"))
         
         # Save original dimensions
         orig_height, orig_width, _ = original_img.shape
@@ -170,41 +202,55 @@ def import_and_predict(image_data, sensitivity=9):
         contour_thickness = max(2, int(max_dimension / 200))  # Adjust the divisor to control scaling
 
         # Preprocess the image for the model
-        img_resized = cv2.resize(original_img, (224, 224))
-        img_tensor = np.expand_dims(img_resized, axis=0) / 255.0
-        preprocessed_img = img_tensor
+        interpolation = cv2.INTER_AREA if orig_width > 224 and orig_height > 224 else cv2.INTER_LINEAR  # INTER_AREA only pays off when downscaling
+        img_resized = cv2.resize(original_img, (224, 224), interpolation=interpolation)
+        img_tensor = np.expand_dims(img_resized, axis=0)  # uint8, normalized inside the model graph
+        preprocessed_img = tf.convert_to_tensor(img_tensor)
         
-        # Define a new model that outputs the conv2d_3 feature maps and the prediction
-        custom_model = Model(inputs=model.inputs, 
-                             outputs=(model.layers[sensitivity].output, model.layers[-1].output))  # `conv2d_3` and predictions
+        # Get the compiled model that outputs the conv2d_3 feature maps and the prediction
+        infer = get_cam_infer(sensitivity)
 
         # Get the conv2d_3 output and the predictions
-        conv2d_3_output, pred_vec = custom_model.predict(preprocessed_img)
+        conv2d_3_output, pred_vec = (output.numpy() for output in infer(preprocessed_img))
         conv2d_3_output = np.squeeze(conv2d_3_output)  # (28, 28, 32) feature maps
 
         # Prediction for the image
-        pred = np.argmax(pred_vec)
-        
-        # Resize the conv2d_3 output to match the input image size
-        heat_map_resized = cv2.resize(conv2d_3_output, (orig_width, orig_height), interpolation=cv2.INTER_LINEAR)
+        pred = int(np.argmax(pred_vec))
+
+        # Add white borders (to the converted RGB image, since the RGB fill fails on grayscale modes)
+        border_size = 10  # Set the border size
+        image_with_border = add_white_border(Image.fromarray(original_img), border_size)
 
+        # Crack localization is only shown for cracked walls, so skip the heatmap and contour work otherwise
+        if pred != 1:
+            return pred_vec, image_with_border, image_with_border, image_data, image_data, image_data
+        
         # Average all the filters from conv2d_3 to get a single activation map
-        heat_map = np.mean(heat_map_resized, axis=-1)  # (orig_height, orig_width)
+        # (the mean commutes with the linear resize, so average at 28x28 before upsampling)
+        heat_map = conv2d_3_output.mean(axis=-1, dtype=np.float32)  # (28, 28)
+
+        # Scale to 0-255 on the small map (linear, so it commutes with the bilinear resize and
+        # the resized values stay at or below 255)
+        max_value = heat_map.max()
+        if max_value > 0:
+            heat_map *= np.float32(255.0 / max_value)
+
+        # Resize the activation map to match the input image size
+        heat_map = cv2.resize(heat_map, (orig_width, orig_height), interpolation=cv2.INTER_LINEAR)  # (orig_height, orig_width)
 
-        # Normalize the heatmap for better visualization
-        heat_map = np.maximum(heat_map, 0)  # ReLU to eliminate negative values
-        heat_map = heat_map / heat_map.max()  # Normalize to 0-1
+        # ReLU after the resize (it does not commute with interpolation); convertScaleAbs below would fold negatives up
+        np.maximum(heat_map, 0, out=heat_map)
 
         # Threshold the heatmap to get the regions with the highest activation
         threshold = 0.5  # Adjust this threshold if needed
-        heat_map_thresh = np.uint8(255 * heat_map)
+        heat_map_thresh = cv2.convertScaleAbs(heat_map)  # One pass to 0-255 uint8
         _, thresh_map = cv2.threshold(heat_map_thresh, int(255 * threshold), 255, cv2.THRESH_BINARY)
 
         # Find contours in the thresholded heatmap
         contours, _ = cv2.findContours(thresh_map, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
         # Convert heatmap to RGB for display
-        heatmap_colored = np.uint8(255 * cm.jet(heat_map)[:, :, :3])
+        heatmap_colored = JET_LUT[heat_map_thresh]  # Gather from the 0-255 heatmap computed for thresholding
         
         # Convert heatmap to PIL format
         heatmap_image = Image.fromarray(heatmap_colored)
@@ -216,16 +262,10 @@ def import_and_predict(image_data, sensitivity=9):
         # Convert contoured image to PIL format
         contoured_image = Image.fromarray(contoured_img)
 
-        # Overlay heatmap on original image
-        heatmap_image_rgba = heatmap_image.convert("RGBA")
-        original_img_pil = Image.fromarray(original_img).convert("RGBA")
-        heatmap_overlay = Image.blend(original_img_pil, heatmap_image_rgba, alpha=0.5)
+        # Overlay heatmap on original image in a single RGB blend (no RGBA/PIL round-trips)
+        heatmap_overlay_rgb_np = cv2.addWeighted(original_img, 0.5, heatmap_colored, 0.5, 0)
 
         # Draw contours on the heatmap-overlayed image
-        # Convert heatmap-overlayed image to RGB for contour drawing
-        heatmap_overlay_rgb = heatmap_overlay.convert("RGB")
-        heatmap_overlay_rgb_np = np.array(heatmap_overlay_rgb)
-        # heatmap_overlay_np = np.array(heatmap_overlay)
         cv2.drawContours(heatmap_overlay_rgb_np, contours, -1, (0, 0, 0), contour_thickness)  # Draw blue contours
 
         # Convert overlay image to PIL format
@@ -235,9 +275,7 @@ def import_and_predict(image_data, sensitivity=9):
         class_labels = ["Normal", "Cracked", "Not a Wall"]
         predicted_class = class_labels[pred]
 
-        # Add white borders
-        border_size = 10  # Set the border size
-        image_with_border = add_white_border(image_data, border_size)
+        # Add white border to the localization image
         contours_with_border = add_white_border(overlay_img, border_size)
 
         return pred_vec, image_with_border, contours_with_border, heatmap_image, contoured_image, overlay_img 
@@ -245,6 +283,12 @@ def import_and_predict(image_data, sensitivity=9):
         st.error(f"An error occurred during prediction: {e}")
         return None, None, None, None, None, None
         
+# Cache the results per uploaded file and sensitivity, so reruns from other widgets skip all the work
+# (few entries and an hour's lifetime: each one holds five full-resolution images)
+@st.cache_data(max_entries=8, ttl=3600, show_spinner=False)
+def cached_predict(_image_data, image_key, sensitivity=9):
+    return import_and_predict(_image_data, sensitivity=sensitivity)
+
 # Adds border to the image
 
 def add_white_border(image, border_size):
@@ -257,18 +301,19 @@ if file is None:
 else:
     with st.spinner("Processing image..."):
         try:
-            # Try to open the uploaded image using PIL
-            image = Image.open(file)
+            # Try to open the uploaded image using PIL and correct the orientation if necessary
+            file_bytes = file.getvalue()
+            image = decode_and_orient(file_bytes)
             if image is None:
                 raise ValueError("Uploaded file is not a valid image.")
-            
-            # Correct the orientation if necessary
-            image = correct_orientation(image)
+
+            # Key the cached results on the uploaded bytes
+            image_key = hashlib.blake2b(file_bytes, digest_size=16).hexdigest()
 
             
             
             # Perform prediction
-            predictions, image_with_border, contours_with_border, heatmap_image, contoured_image, overlay_img  = import_and_predict(image)
+            predictions, image_with_border, contours_with_border, heatmap_image, contoured_image, overlay_img  = cached_predict(image, image_key)
             if predictions is not None:
                 predicted_class = np.argmax(predictions)
                 prediction_percentages = predictions[0] * 100
@@ -311,7 +356,7 @@ else:
 
 
                 # Perform prediction again
-                predictions, image_with_border, contours_with_border, heatmap_image, contoured_image, overlay_img  = import_and_predict(image, sensitivity=sensitivity)
+                predictions, image_with_border, contours_with_border, heatmap_image, contoured_image, overlay_img  = cached_predict(image, image_key, sensitivity=sensitivity)
 
                 #in one row
                 col1, col2, col3, col4 = st.columns(4)
@@ -401,6 +446,9 @@ else:
                     </style>
                     """
                     st.markdown(center_style, unsafe_allow_html=True)
+
+                    # Imported here so the component only loads once the slider is requested
+                    from streamlit_image_comparison import image_comparison
                     
                     # Opening div tag to center the image comparison component
                     st.markdown('<div class="centered-image-container">', unsafe_allow_html=True)